@@ -7,6 +7,7 @@
 # ============================================================================
 
 !pip install transformers torch gradio accelerate bitsandbytes -q
+!pip install autoawq -q
 
 print("✅ All libraries installed successfully!")
 
@@ -14,11 +15,19 @@ print("✅ All libraries installed successfully!")
 # CELL 2: Import Libraries and Setup
 # ============================================================================
 
+import inspect
+import os
+
+# Let the caching allocator grow segments in place instead of fragmenting (set before CUDA init)
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import torch
 import gradio as gr
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, StaticCache, pipeline
 import warnings
-import gc
+import queue
+import threading
+import time
 warnings.filterwarnings("ignore")
 
 # Check if GPU is available
@@ -27,12 +36,29 @@ print(f"🔥 Using device: {device}")
 print(f"🔥 GPU Name: {torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'No GPU'}")
 print(f"🔥 Available GPU Memory: {torch.cuda.get_device_properties(0).total_memory / 1e9:.1f} GB" if torch.cuda.is_available() else "")
 
+# bf16 on Ampere+ (same tensor-core rate as fp16, fp32 exponent range); fp16 on T4 / CPU
+use_bf16 = torch.cuda.is_available() and torch.cuda.get_device_capability(0)[0] >= 8
+dtype = torch.bfloat16 if use_bf16 else torch.float16
+print(f"🔥 Compute dtype: {dtype}")
+
+# Allow TF32 tensor cores for any remaining fp32 matmuls / convolutions
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
 # ============================================================================
 # CELL 3: Load Granite 3.2 2B Instruct Model
 # ============================================================================
 
 # Model configuration
 model_name = "ibm-granite/granite-3.2-2b-instruct"
+awq_model_name = "ibm-granite/granite-3.2-2b-instruct-awq"  # Pre-quantized W4A16 weights
+use_8bit_fallback = False  # Use bitsandbytes int8 instead of NF4 when AWQ is unavailable
+
+# PyTorch SDPA (fused flash / memory-efficient kernels). HF's flash_attention_2 path unpads
+# the [batch, max_cache_len] StaticCache mask with host syncs every layer, which breaks the
+# sync-free, graph-captured decode loop below.
+attn_implementation = "sdpa"
 
 print("🤖 Loading Granite 3.2 2B Instruct model...")
 print("⏳ This may take 2-3 minutes...")
@@ -40,7 +66,7 @@ print("⏳ This may take 2-3 minutes...")
 try:
     # Load tokenizer
     print("📝 Loading tokenizer...")
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)  # Rust tokenizer
     
     # Add padding token if not present
     if tokenizer.pad_token is None:
@@ -48,64 +74,580 @@ try:
     
     # Load model with optimization for Colab
     print("🧠 Loading model...")
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        torch_dtype=torch.float16,  # Use half precision for memory efficiency
-        device_map="auto",          # Automatically map to available devices
-        trust_remote_code=True,
-        low_cpu_mem_usage=True
-    )
+    model = None
+    model_precision = "BF16" if use_bf16 else "FP16"
+    
+    # Decode is memory-bandwidth bound: 4-bit AWQ weights cut bytes read per token ~4x
+    if torch.cuda.is_available():
+        try:
+            model = AutoModelForCausalLM.from_pretrained(
+                awq_model_name,
+                torch_dtype=torch.float16,  # AWQ kernels are FP16-only; activations stay FP16 (W4A16)
+                device_map="auto",
+                attn_implementation=attn_implementation,
+                low_cpu_mem_usage=True
+            )
+            model_precision = "AWQ W4A16"
+        except Exception as e:
+            print(f"⚠️ AWQ weights unavailable, falling back to bitsandbytes: {e}")
+    
+    # Fallback: quantize the FP16 checkpoint on load with bitsandbytes
+    if model is None and torch.cuda.is_available():
+        try:
+            if use_8bit_fallback:
+                # threshold=0.0 skips the slow mixed-precision outlier path
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=0.0)
+                precision = "INT8"
+            else:
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                    bnb_4bit_compute_dtype=dtype
+                )
+                precision = "NF4"
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                quantization_config=quantization_config,
+                torch_dtype=dtype,  # Non-quantized modules and activations match the compute dtype
+                device_map="auto",
+                attn_implementation=attn_implementation,
+                trust_remote_code=True,
+                low_cpu_mem_usage=True
+            )
+            model_precision = precision
+        except Exception as e:
+            print(f"⚠️ bitsandbytes quantization failed, falling back to {model_precision}: {e}")
+    
+    if model is None:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=dtype,          # Use half precision for memory efficiency
+            device_map="auto",          # Automatically map to available devices
+            attn_implementation=attn_implementation,
+            trust_remote_code=True,
+            low_cpu_mem_usage=True
+        )
+    
+    model.eval()  # Inference only: no dropout
     
     print("✅ Granite 3.2 2B Instruct model loaded successfully!")
     print(f"📊 Model parameters: ~2B")
-    print(f"💾 Model size: ~4GB (FP16)")
+    print(f"💾 Model size: ~{model.get_memory_footprint() / 1e9:.1f}GB ({model_precision})")
+    print(f"⚡ Attention: {attn_implementation}")
     
 except Exception as e:
     print(f"❌ Error loading model: {e}")
     print("💡 Try restarting runtime and ensuring GPU is enabled")
 
+# Compile the forward pass once per session: autotuned GEMMs, fusion and CUDA graphs
+# Only the decode step is compiled; prefill runs eager so prompt buckets add no compiled shapes
+decode_forward = model
+model_compiled = False
+if torch.cuda.is_available() and model_precision != "INT8":  # compile gives no speedup on int8
+    try:
+        print("⚙️ Compiling model with torch.compile (max-autotune)...")
+        torch._dynamo.config.cache_size_limit = 16  # 4 batch sizes x 4 KV-cache buckets of decode
+        torch._inductor.config.triton.cudagraphs = True  # Whole decode step as one graph launch
+        torch._inductor.config.epilogue_fusion = True    # Fuse pointwise ops into GEMM epilogues
+        torch._inductor.config.shape_padding = True      # Pad GEMM shapes to tensor-core friendly sizes
+        decode_forward = torch.compile(model.forward, mode="max-autotune", fullgraph=False, dynamic=False)
+        model_compiled = True
+        # Decode autotunes during warmup_model() for every batch size x cache bucket
+        print("✅ Model compiled (autotuning runs during warmup and can take several minutes)")
+    except Exception as e:
+        print(f"⚠️ torch.compile unavailable, running eager: {e}")
+
 # ============================================================================
 # CELL 4: Create Text Generation Functions
 # ============================================================================
 
-def generate_response(prompt, max_length=512, temperature=0.7, top_p=0.9, do_sample=True):
+# KV-cache lengths we capture decode graphs for (prompt + new tokens)
+CACHE_BUCKETS = (256, 512, 1024, 2048)
+GRAPH_WARMUP_STEPS = 3
+
+# Prompts are left-padded to a power of two in this range so prefill shapes repeat
+PROMPT_BUCKETS = (64, 128, 256, 512, 1024)
+PROMPT_BUCKET_MIN = PROMPT_BUCKETS[0]
+PROMPT_BUCKET_MAX = PROMPT_BUCKETS[-1]
+
+# Largest response that still fits the largest cache bucket after a full-size prompt
+MAX_NEW_TOKENS = CACHE_BUCKETS[-1] - PROMPT_BUCKET_MAX
+
+# Tokens decoded on-device between host syncs (EOS check + streaming flush)
+SYNC_INTERVAL = 4
+
+# Concurrent requests are decoded together; batches are padded up to these sizes
+MAX_BATCH_SIZE = 8
+BATCH_SIZES = (1, 2, 4, 8)
+BATCH_WINDOW_SECONDS = 0.005  # How long the batcher waits for more requests
+
+# Prefill only needs last-position logits; the kwarg was renamed in newer transformers
+forward_params = inspect.signature(type(model).forward).parameters
+if "logits_to_keep" in forward_params:
+    last_logits_kwargs = {"logits_to_keep": 1}
+elif "num_logits_to_keep" in forward_params:
+    last_logits_kwargs = {"num_logits_to_keep": 1}
+else:
+    last_logits_kwargs = {}
+
+# One captured decode graph per (batch size, cache bucket), reused across requests
+graph_runners = {}
+
+# Persistent prompt buffers, viewed as [batch, bucket] per batch: pinned host staging + device copy
+pin_prompts = torch.cuda.is_available()
+prompt_ids_host = torch.empty(MAX_BATCH_SIZE * PROMPT_BUCKET_MAX, dtype=torch.long, pin_memory=pin_prompts)
+prompt_mask_host = torch.empty(MAX_BATCH_SIZE * PROMPT_BUCKET_MAX, dtype=torch.long, pin_memory=pin_prompts)
+input_ids_buf = torch.empty(MAX_BATCH_SIZE * PROMPT_BUCKET_MAX, dtype=torch.long, device=model.device)
+attn_mask_buf = torch.empty(MAX_BATCH_SIZE * PROMPT_BUCKET_MAX, dtype=torch.long, device=model.device)
+
+# Recorded after each host-to-device prompt copy; waited on before the staging buffer is refilled
+prompt_copy_done = torch.cuda.Event() if pin_prompts else None
+
+class DecodeGraphRunner:
     """
-    Generate response using Granite 3.2 2B Instruct
+    Owns a fixed-size StaticCache and replays one captured decode step per token
+
+    The cache is allocated once per bucket and reset() between batches, so K/V
+    tensors keep the same addresses (no per-step torch.cat as with DynamicCache).
+    Without a GPU the same loop runs eagerly.
     """
-    try:
-        # Format prompt for instruction following
-        formatted_prompt = f"<|user|>\n{prompt}\n<|assistant|>\n"
+
+    def __init__(self, batch_size, max_cache_len):
+        self.batch_size = batch_size
+        self.max_cache_len = max_cache_len
+        self.cache = StaticCache(
+            config=model.config,
+            max_batch_size=batch_size,
+            max_cache_len=max_cache_len,
+            device=model.device,
+            dtype=model.dtype
+        )
         
-        # Tokenize input
-        inputs = tokenizer(formatted_prompt, return_tensors="pt", truncation=True, max_length=1024)
-        inputs = {k: v.to(model.device) for k, v in inputs.items()}
+        # Persistent buffers - the graph always reads/writes these addresses
+        self.input_ids = torch.zeros((batch_size, 1), dtype=torch.long, device=model.device)
+        self.position_ids = torch.zeros((batch_size, 1), dtype=torch.long, device=model.device)
+        self.cache_position = torch.zeros((1,), dtype=torch.long, device=model.device)
+        self.attention_mask = torch.zeros((batch_size, max_cache_len), dtype=torch.long, device=model.device)
+        self.num_padding = torch.zeros((batch_size, 1), dtype=torch.long, device=model.device)
+        self.logits = None
+        self.graph = None
+
+    def _forward_step(self):
+        return decode_forward(
+            input_ids=self.input_ids,
+            position_ids=self.position_ids,
+            cache_position=self.cache_position,
+            attention_mask=self.attention_mask,
+            past_key_values=self.cache,
+            use_cache=True
+        ).logits
+
+    def capture(self):
+        """Warm up on a side stream, then capture one decode step"""
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            # Finish cuBLAS init / autotuning before capture
+            for _ in range(GRAPH_WARMUP_STEPS):
+                self._forward_step()
+        torch.cuda.current_stream().wait_stream(stream)
         
-        # Generate response
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=max_length,
-                temperature=temperature,
-                top_p=top_p,
-                do_sample=do_sample,
-                pad_token_id=tokenizer.eos_token_id,
-                eos_token_id=tokenizer.eos_token_id,
-                repetition_penalty=1.1
-            )
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.logits = self._forward_step()
+
+    def prefill(self, input_ids, attention_mask):
+        """Run the (left-padded) prompts eagerly to fill the KV cache, return last-token logits"""
+        prompt_len = input_ids.shape[1]
+        self.num_padding.copy_(prompt_len - attention_mask.sum(dim=-1, keepdim=True))
+        self.cache.reset()
+        self.attention_mask.zero_()
+        self.attention_mask[:, :prompt_len] = attention_mask
         
-        # Decode response
-        full_response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+        # Real tokens start at position 0 regardless of how much padding precedes them
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
         
-        # Extract only the assistant's response
-        if "<|assistant|>" in full_response:
-            response = full_response.split("<|assistant|>")[-1].strip()
-        else:
-            response = full_response.replace(formatted_prompt, "").strip()
+        logits = model(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            cache_position=torch.arange(prompt_len, device=model.device),
+            attention_mask=self.attention_mask,
+            past_key_values=self.cache,
+            use_cache=True,
+            **last_logits_kwargs  # Skip full-vocab logits for every prompt position
+        ).logits
+        return logits[:, -1]
+
+    def decode(self, tokens, position):
+        """Feed one token per row at cache slot `position` and return their logits"""
+        self.input_ids.copy_(tokens)
+        self.position_ids.copy_(self.num_padding).neg_().add_(position)
+        self.cache_position.fill_(position)
+        self.attention_mask[:, position] = 1
         
-        return response
+        if self.graph is None:
+            return self._forward_step()[:, -1]
+        self.graph.replay()
+        return self.logits[:, -1]
+
+def get_graph_runner(batch_size, seq_len):
+    """Return (capturing on first use) the decode graph for batch_size and the bucket fitting seq_len"""
+    assert threading.current_thread() is batcher.worker, "Model calls must run on the batcher thread"
+    key = (batch_size, next(b for b in CACHE_BUCKETS if b >= seq_len))
+    if key not in graph_runners:
+        runner = DecodeGraphRunner(*key)
+        try:
+            # The compiled forward (triton.cudagraphs) already replays its own CUDA graphs
+            if torch.cuda.is_available() and not model_compiled:
+                runner.capture()
+        except Exception as e:
+            print(f"⚠️ CUDA graph capture failed for {key}, decoding eagerly: {e}")
+            runner.graph = None
+        graph_runners[key] = runner
+    return graph_runners[key]
+
+def prompt_bucket(prompt_len):
+    """Power-of-two prompt length a prompt of prompt_len tokens is padded to"""
+    bucket = 1 << max(prompt_len - 1, 0).bit_length()
+    return min(max(bucket, PROMPT_BUCKET_MIN), PROMPT_BUCKET_MAX)
+
+def pad_batch(prompts, batch_size):
+    """
+    Left-pad prompt id lists to a shared power-of-two bucket, returning (ids, attention_mask)
+
+    Rows beyond len(prompts) are filler so the batch matches a captured batch size.
+    Results are views into the persistent device buffers, valid until the next batch.
+    """
+    bucket = prompt_bucket(max(len(ids) for ids in prompts))
+    
+    # A failed batch may not have synced, so make sure the last async copy has finished
+    if prompt_copy_done is not None:
+        prompt_copy_done.synchronize()
+    
+    size = batch_size * bucket
+    host_ids = prompt_ids_host[:size].view(batch_size, bucket).fill_(tokenizer.pad_token_id)
+    host_mask = prompt_mask_host[:size].view(batch_size, bucket).zero_()
+    for row in range(batch_size):
+        ids = prompts[row] if row < len(prompts) else [tokenizer.pad_token_id]
+        host_ids[row, bucket - len(ids):] = torch.as_tensor(ids, dtype=torch.long)
+        host_mask[row, bucket - len(ids):] = 1
+    
+    input_ids = input_ids_buf[:size].view(batch_size, bucket)
+    attention_mask = attn_mask_buf[:size].view(batch_size, bucket)
+    input_ids.copy_(host_ids, non_blocking=True)
+    attention_mask.copy_(host_mask, non_blocking=True)
+    if prompt_copy_done is not None:
+        prompt_copy_done.record()
+    return input_ids, attention_mask
+
+def sample_next_token(logits, seen_tokens, temperature, top_p, do_sample, repetition_penalty=1.1):
+    """
+    Pick the next token per row from last-position logits (temperature, top-p, repetition penalty)
+
+    Runs entirely on the GPU: top-p masks the sorted logits and Gumbel-max replaces
+    torch.multinomial, so no host sync is needed per token. temperature, top_p and
+    do_sample are [batch, 1] tensors so every row keeps its own settings.
+    """
+    logits = logits.float()
+    penalized = torch.where(logits < 0, logits * repetition_penalty, logits / repetition_penalty)
+    logits = torch.where(seen_tokens, penalized, logits)
+    greedy = logits.argmax(dim=-1, keepdim=True)
+    
+    sorted_logits, sorted_indices = torch.sort(logits / temperature, dim=-1, descending=True)
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    cumulative_probs = sorted_probs.cumsum(dim=-1)
+    sorted_logits.masked_fill_(cumulative_probs - sorted_probs > top_p, float("-inf"))
+    
+    gumbel_noise = -torch.log(-torch.log(torch.rand_like(sorted_logits)))
+    next_sorted = (sorted_logits + gumbel_noise).argmax(dim=-1, keepdim=True)
+    sampled = sorted_indices.gather(-1, next_sorted)
+    return torch.where(do_sample, sampled, greedy)
+
+class GenerationRequest:
+    """A single prompt waiting for (or being decoded in) a batch"""
+
+    def __init__(self, input_ids, max_length, temperature, top_p, do_sample):
+        self.input_ids = input_ids
+        self.max_length = max_length
+        self.temperature = temperature
+        self.top_p = top_p
+        self.do_sample = do_sample
+        
+        # Lists of new token ids; None marks the end, an Exception a failed batch
+        self.tokens = queue.Queue()
+        self.cancelled = threading.Event()
+        self.done = False
+
+class GenerationBatcher:
+    """
+    Background worker that gathers concurrent requests and decodes them as one batch
+
+    Decode is memory-bandwidth bound, so B rows cost about the same per step as one:
+    the weights are read once per forward pass either way. Requests that arrive
+    while a batch is running are picked up by the next batch.
+
+    The worker is the only thread that may call the model (warmup included): Inductor's
+    CUDA-graph trees keep per-thread state, so compiled calls from another thread fail.
+    """
+
+    def __init__(self):
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        """Queue a request; its tokens arrive on request.tokens"""
+        self.pending.put(request)
+        return request
+
+    def _collect(self):
+        """Block for one request, then take whatever else arrives within the batch window"""
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + BATCH_WINDOW_SECONDS
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return [request for request in batch if not request.cancelled.is_set()]
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                with torch.inference_mode():
+                    self._decode_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.done:
+                        request.tokens.put(e)
+            finally:
+                # Every request must end, even if the decode loop never ran
+                for request in batch:
+                    if not request.done:
+                        request.done = True
+                        request.tokens.put(None)
+
+    def _row_tensor(self, batch, batch_size, name, fill, dtype):
+        values = [getattr(request, name) for request in batch]
+        values += [fill] * (batch_size - len(batch))
+        return torch.tensor(values, dtype=dtype, device=model.device).unsqueeze(-1)
+
+    def _decode_batch(self, batch):
+        batch_size = next(b for b in BATCH_SIZES if b >= len(batch))
+        input_ids, attention_mask = pad_batch([request.input_ids for request in batch], batch_size)
+        prompt_len = input_ids.shape[1]
+        max_length = max(request.max_length for request in batch)
+        runner = get_graph_runner(batch_size, prompt_len + max_length)
+        
+        # Per-row sampling settings; filler rows decode greedily and are ignored
+        temperature = self._row_tensor(batch, batch_size, "temperature", 1.0, torch.float)
+        top_p = self._row_tensor(batch, batch_size, "top_p", 1.0, torch.float)
+        do_sample = self._row_tensor(batch, batch_size, "do_sample", False, torch.bool)
+        
+        logits = runner.prefill(input_ids, attention_mask)
+        
+        # Tokens already in context, for the repetition penalty
+        seen_tokens = torch.zeros_like(logits, dtype=torch.long).scatter_add_(-1, input_ids, attention_mask) > 0
+        
+        # Sampled ids stay on the GPU until the next sync
+        token_buffer = torch.empty((batch_size, max_length), dtype=torch.long, device=model.device)
+        synced = 0
+        
+        for step in range(max_length):
+            if step:
+                logits = runner.decode(next_tokens, prompt_len + step - 1)
+            next_tokens = sample_next_token(logits, seen_tokens, temperature, top_p, do_sample)
+            token_buffer[:, step:step + 1] = next_tokens
+            seen_tokens.scatter_(-1, next_tokens, True)
+            
+            if (step + 1) % SYNC_INTERVAL and step + 1 < max_length:
+                continue
+            
+            # One host sync per SYNC_INTERVAL tokens for the whole batch
+            new_tokens = token_buffer[:, synced:step + 1].tolist()
+            for row, request in enumerate(batch):
+                if request.done:
+                    continue
+                tokens = new_tokens[row][:max(request.max_length - synced, 0)]
+                finished = request.cancelled.is_set() or step + 1 >= request.max_length
+                # Drop anything sampled after EOS
+                if tokenizer.eos_token_id in tokens:
+                    tokens = tokens[:tokens.index(tokenizer.eos_token_id)]
+                    finished = True
+                if tokens:
+                    request.tokens.put(tokens)
+                if finished:
+                    request.done = True
+                    request.tokens.put(None)
+            synced = step + 1
+            
+            if all(request.done for request in batch):
+                break
+
+def format_conversation(messages, add_generation_prompt=True):
+    """Format chat messages with Granite's own chat template (correct special tokens)"""
+    return tokenizer.apply_chat_template(
+        [{"role": m["role"], "content": m["content"]} for m in messages],
+        tokenize=False,
+        add_generation_prompt=add_generation_prompt
+    )
+
+# A fixed first message lets every later message be rendered on its own, whatever came before
+TEMPLATE_ANCHOR = {"role": "user", "content": "."}
+anchor_text = format_conversation([TEMPLATE_ANCHOR], add_generation_prompt=False)
+
+def message_text(message):
+    """Template text for a single message, without the preamble the template puts up front"""
+    return format_conversation([TEMPLATE_ANCHOR, message], add_generation_prompt=False)[len(anchor_text):]
+
+# The preamble (Granite's default system prompt) and generation prompt never change - tokenize once
+preamble_ids = tokenizer(
+    anchor_text[:len(anchor_text) - len(message_text(TEMPLATE_ANCHOR))], add_special_tokens=False
+)["input_ids"]
+generation_prompt_ids = tokenizer(
+    format_conversation([TEMPLATE_ANCHOR])[len(anchor_text):], add_special_tokens=False
+)["input_ids"]
+
+def conversation_input_ids(messages):
+    """
+    Token ids for the conversation plus generation prompt
+
+    Each message caches its own ids under "input_ids", so only new turns are rendered and
+    tokenized. When the prompt outgrows the largest bucket, whole oldest messages are dropped
+    while the preamble is kept.
+    """
+    for message in messages:
+        if "input_ids" not in message:
+            message["input_ids"] = tokenizer(message_text(message), add_special_tokens=False)["input_ids"]
+    
+    budget = PROMPT_BUCKET_MAX - len(preamble_ids) - len(generation_prompt_ids)
+    kept = []
+    used = 0
+    for message in reversed(messages):
+        if kept and used + len(message["input_ids"]) > budget:
+            break
+        kept.insert(0, message)
+        used += len(message["input_ids"])
+    
+    # Start the kept context on a user turn
+    while len(kept) > 1 and kept[0]["role"] != "user":
+        kept.pop(0)
+    
+    # Only a single oversized message is ever cut, keeping its end
+    context = [token for message in kept for token in message["input_ids"]][-budget:]
+    return preamble_ids + context + generation_prompt_ids
+
+GENERATION_ERROR_PREFIX = "❌ Error generating response:"
+
+# Single worker that owns the model; all generation goes through it
+batcher = GenerationBatcher()
+
+def stream_response(messages, max_length=512, temperature=0.7, top_p=0.9, do_sample=True):
+    """
+    Stream a response from Granite 3.2 2B Instruct, yielding the text decoded so far
+    """
+    request = None
+    try:
+        max_length = int(max_length)
+        if not 1 <= max_length <= MAX_NEW_TOKENS:
+            raise ValueError(f"max_length must be between 1 and {MAX_NEW_TOKENS}, got {max_length}")
+        
+        # Tokenize input (cached per message) and join the next batch
+        request = batcher.submit(GenerationRequest(
+            conversation_input_ids(messages), max_length, temperature, top_p, do_sample
+        ))
+        
+        generated = []
+        response = ""
+        while True:
+            tokens = request.tokens.get()
+            if tokens is None:
+                break
+            if isinstance(tokens, Exception):
+                raise tokens
+            generated.extend(tokens)
+            
+            # Decode only the newly generated tokens; skip yields that add no text
+            text = tokenizer.decode(generated, skip_special_tokens=True).strip()
+            if text != response:
+                response = text
+                yield response
         
     except Exception as e:
-        return f"❌ Error generating response: {str(e)}"
+        yield f"{GENERATION_ERROR_PREFIX} {str(e)}"
+    finally:
+        # Also runs when the consumer stops early, so the batch can drop this row
+        if request is not None:
+            request.cancelled.set()
+
+def generate_response(prompt, max_length=512, temperature=0.7, top_p=0.9, do_sample=True):
+    """
+    Generate a complete response using Granite 3.2 2B Instruct
+    """
+    messages = [{"role": "user", "content": prompt}]
+    response = ""
+    for response in stream_response(messages, max_length, temperature, top_p, do_sample):
+        pass
+    return response
+
+def warmup_batch(prompt_len, max_length, batch_size):
+    """
+    Run one short batch of batch_size dummy prompts through the batcher
+
+    Each row is cancelled after its first streamed update (SYNC_INTERVAL decode steps).
+    Raises if the worker reports an error instead of silently warming nothing.
+    """
+    requests = [
+        batcher.submit(GenerationRequest([tokenizer.eos_token_id] * prompt_len, max_length, 1.0, 1.0, False))
+        for _ in range(batch_size)
+    ]
+    updates = [request.tokens.get() for request in requests]
+    for request in requests:
+        request.cancelled.set()
+    
+    for request, update in zip(requests, updates):
+        while update is not None:
+            if isinstance(update, Exception):
+                raise RuntimeError(f"{GENERATION_ERROR_PREFIX} warmup (batch {batch_size}, prompt {prompt_len}) failed: {update}") from update
+            update = request.tokens.get()
+
+def warmup_model():
+    """
+    Compile / capture every shape serving can reach before the app goes live
+
+    Covers each batch size x prompt bucket x cache bucket a user request can land in,
+    going through the batcher thread exactly like a real request.
+    """
+    for batch_size in BATCH_SIZES:
+        for padded_len in PROMPT_BUCKETS:
+            for cache_len in CACHE_BUCKETS:
+                # Skip pairs no allowed max_length can reach from this prompt bucket
+                max_length = min(cache_len - padded_len, MAX_NEW_TOKENS)
+                if max_length < 1 or next(b for b in CACHE_BUCKETS if b >= padded_len + max_length) != cache_len:
+                    continue
+                warmup_batch(padded_len, max_length, batch_size)
+        print(f"🔥 Warmed up batch size {batch_size}")
+
+# Warm up so compilation / graph capture happens before the app goes live
+# torch.compile is lazy, so real compile failures only surface here
+print("🔥 Warming up generation...")
+try:
+    warmup_model()
+except Exception as e:
+    if not model_compiled:
+        raise
+    print(f"⚠️ Compiled decode failed during warmup, falling back to eager + CUDA graphs: {e}")
+    decode_forward = model
+    model_compiled = False
+    graph_runners.clear()  # Runners made while compiled never captured a graph
+    warmup_model()
 
 # Test the function
 print("🧪 Testing text generation...")
@@ -116,37 +658,42 @@ print(f"🤖 Test Response: {test_response}")
 # CELL 5: Create Advanced Gradio Interface
 # ============================================================================
 
-# Conversation history storage
-conversation_history = []
+# Number of recent user/assistant turns kept as model context per session
+MAX_HISTORY_TURNS = 16
 
-def chat_with_granite(message, history, max_length, temperature, top_p):
+def chat_with_granite(message, history, conversation_history, max_length, temperature, top_p):
     """
-    Enhanced chat function with conversation history
+    Enhanced chat function with conversation history, streaming tokens as they decode
+
+    conversation_history is per-session gr.State, so concurrent users never share context.
     """
-    global conversation_history
-    
     if not message.strip():
-        return history, ""
+        yield history, "", conversation_history
+        return
     
-    # Add user message to history
+    # Edit the session's list in place: on Stop the generator is closed before it can
+    # yield again, so only in-place changes reach the stored state
+    del conversation_history[:-2 * (MAX_HISTORY_TURNS - 1)]
     conversation_history.append({"role": "user", "content": message})
     
-    # Generate response
-    response = generate_response(message, max_length, temperature, top_p)
+    # Show the user message immediately, then fill in the reply as it streams
+    history.append([message, ""])
+    yield history, "", conversation_history
     
-    # Add assistant response to history
-    conversation_history.append({"role": "assistant", "content": response})
-    
-    # Update chat history for display
-    history.append([message, response])
-    
-    return history, ""
+    response = ""
+    try:
+        for response in stream_response(conversation_history, max_length, temperature, top_p):
+            history[-1][1] = response
+            yield history, "", conversation_history
+    finally:
+        # Runs on Stop too, so the partial reply is kept; errors are shown but not stored
+        if not response.startswith(GENERATION_ERROR_PREFIX):
+            conversation_history.append({"role": "assistant", "content": response})
+    yield history, "", conversation_history
 
 def clear_conversation():
     """Clear conversation history"""
-    global conversation_history
-    conversation_history = []
-    return []
+    return [], []
 
 def set_example_prompt(prompt):
     """Set example prompt in the textbox"""
@@ -156,10 +703,14 @@ def set_example_prompt(prompt):
 # CELL 6: Launch Gradio Interface
 # ============================================================================
 
+# Public tunnel adds network RTT to every streamed update - opt in with GRADIO_SHARE=1
+SHARE = os.environ.get("GRADIO_SHARE", "0") == "1"
+
 # Create Gradio interface
 with gr.Blocks(
     title="🚀 Granite 3.2 2B AI Assistant", 
     theme=gr.themes.Soft(),
+    analytics_enabled=False,
     css="""
     .gradio-container {
         max-width: 1200px !important;
@@ -170,6 +721,9 @@ with gr.Blocks(
     """
 ) as demo:
     
+    # Per-session conversation history (role/content dicts with cached token ids)
+    conversation_state = gr.State([])
+    
     gr.Markdown("""
     # 🚀 Granite 3.2 2B AI Assistant
     
@@ -208,6 +762,7 @@ with gr.Blocks(
                 send_btn = gr.Button("Send 🚀", variant="primary", scale=1, size="lg")
             
             with gr.Row():
+                stop_btn = gr.Button("Stop ⏹️", variant="stop", size="sm")
                 clear_btn = gr.Button("Clear Chat 🗑️", variant="secondary", size="sm")
         
         with gr.Column(scale=1):
@@ -276,21 +831,30 @@ with gr.Blocks(
             )
     
     # Event handlers
-    send_btn.click(
+    send_event = send_btn.click(
         fn=chat_with_granite,
-        inputs=[msg, chatbot, max_length, temperature, top_p],
-        outputs=[chatbot, msg]
+        inputs=[msg, chatbot, conversation_state, max_length, temperature, top_p],
+        outputs=[chatbot, msg, conversation_state],
+        api_name="chat",
+        concurrency_limit=MAX_BATCH_SIZE  # Let concurrent sessions share a batch
     )
     
-    msg.submit(
+    submit_event = msg.submit(
         fn=chat_with_granite,
-        inputs=[msg, chatbot, max_length, temperature, top_p],
-        outputs=[chatbot, msg]
+        inputs=[msg, chatbot, conversation_state, max_length, temperature, top_p],
+        outputs=[chatbot, msg, conversation_state],
+        concurrency_limit=MAX_BATCH_SIZE
+    )
+    
+    # Cancelling closes the streaming generator, which stops the decode loop
+    stop_btn.click(
+        fn=None,
+        cancels=[send_event, submit_event]
     )
     
     clear_btn.click(
         fn=clear_conversation,
-        outputs=chatbot
+        outputs=[chatbot, conversation_state]
     )
     
     # Footer
@@ -311,12 +875,13 @@ print("⏳ Starting Gradio interface...")
 
 try:
     demo.launch(
-        share=True,              # Create public shareable link
-        debug=True,              # Enable debug mode
+        share=SHARE,             # Public shareable link only when requested
+        debug=False,             # No per-request debug logging on the hot path
         server_name="0.0.0.0",   # Allow external access
         server_port=7860,        # Default Gradio port
-        show_error=True,         # Show errors in interface
-        quiet=False              # Show startup logs
+        show_error=False,        # Errors are already reported in the chat
+        quiet=True,              # Keep startup logs short
+        max_threads=MAX_BATCH_SIZE  # No more workers than one decode batch can feed
     )
 except Exception as e:
     print(f"❌ Error launching interface: {e}")
@@ -327,38 +892,44 @@ except Exception as e:
 # ============================================================================
 
 def clear_gpu_memory():
-    """Clear GPU memory cache"""
+    """
+    Reset peak GPU memory stats
+
+    Deliberately does not call torch.cuda.empty_cache(): releasing the allocator's
+    cached blocks forces synchronous cudaMalloc/cudaFree on the next request and can
+    invalidate captured CUDA graphs. Safe to run while the app is serving.
+    """
     if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-        gc.collect()
-        print("🧹 GPU memory cleared")
+        torch.cuda.reset_peak_memory_stats()
+        print("🧹 Peak GPU memory stats reset")
     else:
-        print("ℹ️ No GPU available to clear")
+        print("ℹ️ No GPU available")
 
 def check_gpu_memory():
     """Check current GPU memory usage"""
     if torch.cuda.is_available():
         allocated = torch.cuda.memory_allocated() / 1e9
         cached = torch.cuda.memory_reserved() / 1e9
+        peak = torch.cuda.max_memory_allocated() / 1e9
         total = torch.cuda.get_device_properties(0).total_memory / 1e9
-        print(f"📊 GPU Memory - Allocated: {allocated:.1f}GB, Cached: {cached:.1f}GB, Total: {total:.1f}GB")
+        print(f"📊 GPU Memory - Allocated: {allocated:.1f}GB, Peak: {peak:.1f}GB, Cached: {cached:.1f}GB, Total: {total:.1f}GB")
     else:
         print("ℹ️ No GPU available")
 
 # Run memory check
 check_gpu_memory()
 
-print("""
+print(f"""
 🎉 **Granite AI Assistant is Ready!**
 
 📋 **What you can do:**
 1. Chat with the AI using the interface above
 2. Adjust parameters for different response styles
 3. Try the example prompts to get started
-4. Share the public link with others
-5. Clear memory if needed using the functions below
+4. Share the public link with others (set GRADIO_SHARE=1 before launching)
+5. Check memory usage with check_gpu_memory() / clear_gpu_memory()
 
-🔗 **Your app is now live and accessible via the public Gradio link!**
+🔗 **Your app is now live at http://localhost:7860{' and via the public Gradio link' if SHARE else ''}!**
 """)
 
 # ============================================================================